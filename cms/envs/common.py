@@ -1237,6 +1237,8 @@ OAUTH2_PROVIDER_APPLICATION_MODEL = 'oauth2_provider.Application'
 # Used with Email sending
 RETRY_ACTIVATION_EMAIL_MAX_ATTEMPTS = 5
 RETRY_ACTIVATION_EMAIL_TIMEOUT = 0.5
+RETRY_EMAIL_CHANGE_NOTIFICATION_MAX_ATTEMPTS = 5
+RETRY_EMAIL_CHANGE_NOTIFICATION_TIMEOUT = 0.5
 
 ############## DJANGO-USER-TASKS ##############
 
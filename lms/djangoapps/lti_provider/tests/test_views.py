@@ -3,7 +3,8 @@ Tests for the LTI provider views
 """
 
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.test import TestCase, TransactionTestCase
 from django.test.client import RequestFactory
 from mock import patch, MagicMock
 from nose.plugins.attrib import attr
@@ -163,6 +164,31 @@ class LtiLaunchTest(LtiTestMixin, TestCase):
         self.assertEqual(consumer.instance_guid, u'consumer instance guid')
 
 
+class LtiDeleteUserAccountTest(LtiTestMixin, TransactionTestCase):
+    """
+    Tests for the users_delete_user_account view, which runs outside of the request
+    transaction. This is a TransactionTestCase so that ATOMIC_REQUESTS applies.
+    """
+    @patch(
+        'openedx.core.djangoapps.user_api.accounts.api.anonymize_user_discussions',
+        MagicMock(side_effect=ValueError("Unexpected error"))
+    )
+    def test_deletion_committed_on_unexpected_error(self):
+        """
+        Verifies that the user is still deleted when updating the forums fails
+        unexpectedly, even though the view then returns Not Found.
+        """
+        user = UserFactory.create()
+        params = dict(LTI_DEFAULT_PARAMS, puid=u'', email=user.email)
+
+        response = self.client.post(reverse('lti_provider_delete_user_account'), data=params)
+
+        self.assertEqual(response.status_code, 404)
+        deleted_user = User.objects.get(id=user.id)
+        self.assertFalse(deleted_user.is_active)
+        self.assertNotEqual(deleted_user.username, user.username)
+
+
 @attr(shard=3)
 class LtiLaunchTestRender(LtiTestMixin, RenderXBlockTestMixin, ModuleStoreTestCase):
     """
@@ -4,6 +4,7 @@ LTI Provider view functions
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from django.http import HttpResponseBadRequest, HttpResponseForbidden, Http404, HttpResponse, HttpResponseNotAllowed
 from django.views.decorators.csrf import csrf_exempt
 import logging
@@ -251,6 +252,9 @@ def users_social_auth_mapping(request):
     return HttpResponse(status=204)
 
 
+# delete_user_account commits the local deletion before updating the forums, which it
+# cannot do inside the request transaction.
+@transaction.non_atomic_requests
 @csrf_exempt
 def users_delete_user_account(request):
     """
@@ -369,6 +369,11 @@ FEATURES = {
 
     # Set this to False to facilitate cleaning up invalid xml from your modulestore.
     'ENABLE_XBLOCK_XML_VALIDATION': True,
+
+    # Send the notifications for a forced (MSA migration) email change from a celery
+    # task rather than during the request. Set to False to send them synchronously,
+    # rolling back the change if either email cannot be sent.
+    'ENABLE_ASYNC_EMAIL_CHANGE_NOTIFICATIONS': True,
 }
 
 # Ignore static asset files on import which match this pattern
@@ -386,6 +391,8 @@ XQUEUE_WAITTIME_BETWEEN_REQUESTS = 5  # seconds
 # Used with Email sending
 RETRY_ACTIVATION_EMAIL_MAX_ATTEMPTS = 5
 RETRY_ACTIVATION_EMAIL_TIMEOUT = 0.5
+RETRY_EMAIL_CHANGE_NOTIFICATION_MAX_ATTEMPTS = 5
+RETRY_EMAIL_CHANGE_NOTIFICATION_TIMEOUT = 0.5
 
 ############################# SET PATH INFORMATION #############################
 PROJECT_ROOT = path(__file__).abspath().dirname().dirname()  # /edx-platform/lms
@@ -1763,6 +1770,7 @@ DEBUG_TOOLBAR_PATCH_SETTINGS = False
 # Tasks are only registered when the module they are defined in is imported.
 CELERY_IMPORTS = (
     'openedx.core.djangoapps.programs.tasks.v1.tasks',
+    'openedx.core.djangoapps.user_api.accounts.tasks',
 )
 
 # Message configuration
@@ -3073,3 +3081,9 @@ MSA_ACCOUNT_MIGRATION_STATUS_KEY = 'microsoft_account_migration_status'
 MSA_MIGRATION_STATUS_NOT_STARTED = 'migration_not_started'
 MSA_MIGRATION_STATUS_STARTED_NOT_CONFIRMED = 'migration_started_not_confirmed'
 MSA_MIGRATION_STATUS_COMPLETED = 'migration_completed'
+
+############# Settings for user account deletion ###########################
+
+# Maximum number of concurrent requests made to the comments service when
+# anonymizing the discussion threads of a deleted user.
+ACCOUNT_DELETION_FORUM_UPDATE_WORKERS = 8
@@ -1,25 +1,28 @@
 """
 Programmatic integration point for User API Accounts sub-application
 """
+import logging
 import os
-import random
+import re
 import uuid
+from multiprocessing.pool import ThreadPool
+from django.utils import timezone, translation
 from django.utils.translation import ugettext as _
-from django.db import transaction, IntegrityError
-import datetime
-import hashlib
-from pytz import UTC
-from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Case, Count, Q, Value, When
 from django.conf import settings
-from django.core.validators import validate_email, validate_slug, ValidationError
+from django.core.validators import validate_email, ValidationError
+from requests.exceptions import RequestException
 from social.apps.django_app.default.models import UserSocialAuth
 
 from edxmako.shortcuts import render_to_string
 from openedx.core.djangoapps.user_api.preferences.api import update_user_preferences
 from openedx.core.djangoapps.user_api.errors import PreferenceValidationError
-from student.models import User, UserProfile, Registration
+from openedx.core.djangoapps.user_api.models import UserPreference
+from student.models import CourseEnrollment, User, UserProfile, Registration
 from student import views as student_views
 from third_party_auth.models import UserSocialAuthMapping
+from django_comment_common.models import Role
 from util.model_utils import emit_setting_changed_event
 import lms.lib.comment_client as cc
 from openedx.core.lib.api.view_utils import add_serializer_errors
@@ -33,23 +36,49 @@ from ..forms import PasswordResetFormNoActive
 from ..helpers import intercept_errors
 
 from . import (
-    EMAIL_MIN_LENGTH, EMAIL_MAX_LENGTH, PASSWORD_MIN_LENGTH, PASSWORD_MAX_LENGTH,
+    ACCOUNT_VISIBILITY_PREF_KEY, EMAIL_MIN_LENGTH, EMAIL_MAX_LENGTH, PASSWORD_MIN_LENGTH, PASSWORD_MAX_LENGTH,
     USERNAME_MIN_LENGTH, USERNAME_MAX_LENGTH
 )
 from .serializers import (
     AccountLegacyProfileSerializer, AccountUserSerializer,
     UserReadOnlySerializer, _visible_fields  # pylint: disable=invalid-name
 )
+from .tasks import send_email_change_notification
 from openedx.core.djangoapps.site_configuration import helpers as configuration_helpers
 from lms.lib.comment_client.thread import Thread
 from lms.lib.comment_client.user import User as ThreadUser
-from lms.djangoapps.courseware.courses import get_courses
 from discussion_api.serializers import CommentSerializer, ThreadSerializer
 
+log = logging.getLogger(__name__)
+
 
 # Public access point for this function.
 visible_fields = _visible_fields
 
+# Same pattern as django.core.validators.validate_slug, matched directly so that
+# valid usernames don't pay for the validator's exception handling.
+_USERNAME_SLUG_RE = re.compile(r'^[-a-zA-Z0-9_]+\Z')
+
+# A strict subset of the addresses accepted by django.core.validators.validate_email,
+# covering the common case. Anything it rejects is passed on to validate_email.
+_COMMON_EMAIL_RE = re.compile(
+    r'^[-a-zA-Z0-9_+]+(?:\.[-a-zA-Z0-9_+]+)*'
+    r'@(?:[a-zA-Z0-9](?:[-a-zA-Z0-9]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]{2,6}\Z'
+)
+
+# The User and UserProfile columns read by UserReadOnlySerializer. Other columns, such as
+# the password and the profile's meta, are not loaded by get_account_settings. The profile's
+# 'user' column must be loaded for select_related('profile') to be applied.
+_ACCOUNT_SETTINGS_FIELDS = AccountUserSerializer.Meta.fields + tuple(
+    'profile__' + field.name for field in UserProfile._meta.concrete_fields  # pylint: disable=protected-access
+    if field.name in AccountLegacyProfileSerializer.Meta.fields + ('profile_image_uploaded_at', 'user')
+)
+
+# Fields which cannot be changed through update_account_settings.
+_ACCOUNT_READ_ONLY_FIELDS = frozenset(
+    AccountUserSerializer.get_read_only_fields() + AccountLegacyProfileSerializer.get_read_only_fields()
+)
+
 
 @intercept_errors(UserAPIInternalError, ignore_errors=[UserAPIRequestError])
 def get_account_settings(request, usernames=None, configuration=None, view=None):
@@ -83,21 +112,39 @@ def get_account_settings(request, usernames=None, configuration=None, view=None)
     requesting_user = request.user
     usernames = usernames or [requesting_user.username]
 
-    requested_users = User.objects.select_related('profile').filter(username__in=usernames)
+    # Prefetch the language proficiencies read by the serializer so that the number
+    # of queries does not grow with the number of requested users.
+    requested_users = User.objects.select_related('profile').prefetch_related(
+        'profile__language_proficiencies'
+    ).only(*_ACCOUNT_SETTINGS_FIELDS).filter(username__in=usernames)
     if not requested_users:
         raise UserNotFound()
 
+    # Likewise look up the visibility preferences of all of the requested users at once. Users
+    # who require parental consent are always private, so their preference is not needed.
+    users_with_visibility_preference = [
+        user for user in requested_users if not user.profile.requires_parental_consent()
+    ]
+    if users_with_visibility_preference:
+        account_privacy_preferences = dict(UserPreference.objects.filter(
+            user__in=users_with_visibility_preference, key=ACCOUNT_VISIBILITY_PREF_KEY
+        ).values_list('user_id', 'value'))
+    else:
+        account_privacy_preferences = {}
+
+    all_admin_fields = settings.ACCOUNT_VISIBILITY_CONFIGURATION.get('admin_fields')
     serialized_users = []
     for user in requested_users:
         has_full_access = requesting_user.is_staff or requesting_user.username == user.username
         if has_full_access and view != 'shared':
-            admin_fields = settings.ACCOUNT_VISIBILITY_CONFIGURATION.get('admin_fields')
+            admin_fields = all_admin_fields
         else:
             admin_fields = None
         serialized_users.append(UserReadOnlySerializer(
             user,
             configuration=configuration,
             custom_fields=admin_fields,
+            account_privacy_preferences=account_privacy_preferences,
             context={'request': request}
         ).data)
 
@@ -157,9 +204,7 @@ def update_account_settings(requesting_user, update, username=None, force_email_
         old_name = existing_user_profile.name
 
     # Check for fields that are not editable. Marking them read-only causes them to be ignored, but we wish to 400.
-    read_only_fields = set(update.keys()).intersection(
-        AccountUserSerializer.get_read_only_fields() + AccountLegacyProfileSerializer.get_read_only_fields()
-    )
+    read_only_fields = _ACCOUNT_READ_ONLY_FIELDS.intersection(update)
 
     # Build up all field errors, whether read-only, validation, or email errors.
     field_errors = {}
@@ -198,7 +243,7 @@ def update_account_settings(requesting_user, update, username=None, force_email_
         # We have not found a way using signals to get the language proficiency changes (grouped by user).
         # As a workaround, store old and new values here and emit them after save is complete.
         if "language_proficiencies" in update:
-            old_language_proficiencies = legacy_profile_serializer.data["language_proficiencies"]
+            old_language_proficiencies = list(existing_user_profile.language_proficiencies.values('code'))
 
         for serializer in user_serializer, legacy_profile_serializer:
             serializer.save()
@@ -229,7 +274,7 @@ def update_account_settings(requesting_user, update, username=None, force_email_
             meta['old_names'].append([
                 old_name,
                 u"Name change requested through account API by {0}".format(requesting_user.username),
-                datetime.datetime.now(UTC).isoformat()
+                timezone.now().isoformat()
             ])
             existing_user_profile.set_meta(meta)
             existing_user_profile.save()
@@ -240,8 +285,9 @@ def update_account_settings(requesting_user, update, username=None, force_email_
         raise AccountUpdateError(
             u"Error thrown when saving account updates: '{}'".format(err.message)
         )
-    meta = existing_user_profile.get_meta()
     msa_migration_enabled = configuration_helpers.get_value("ENABLE_MSA_MIGRATION")
+    send_notifications_async = settings.FEATURES.get('ENABLE_ASYNC_EMAIL_CHANGE_NOTIFICATIONS', False)
+    email_change_notifications = []
     # And try to send the email change request if necessary.
     if changing_email:
         if force_email_update and msa_migration_enabled:
@@ -253,47 +299,54 @@ def update_account_settings(requesting_user, update, username=None, force_email_
                     'new_email': new_email
                 }
 
-                if len(User.objects.filter(email=new_email)) != 0:
+                if User.objects.filter(email=new_email).exists():
                     transaction.set_rollback(True)
                     raise AccountUserAlreadyExists
 
                 subject = render_to_string('emails/email_change_subject.txt', address_context)
                 subject = ''.join(subject.splitlines())
                 message = render_to_string('emails/confirm_email_change.txt', address_context)
-                existing_user_profile.set_meta(meta)
-                existing_user_profile.save()
-                # Send it to the old email...
-                try:
-                    existing_user.email_user(
-                        subject,
-                        message,
-                        configuration_helpers.get_value('email_from_address', settings.DEFAULT_FROM_EMAIL)
-                    )
-                except Exception:  # pylint: disable=broad-except
-                    transaction.set_rollback(True)
-                    raise AccountUpdateError(
-                        u"Error thrown from emailing old email address for user: '{}'".format(err.message),
-                        user_message=err.message
-                    )
+                from_address = configuration_helpers.get_value('email_from_address', settings.DEFAULT_FROM_EMAIL)
+                if send_notifications_async:
+                    # Both emails are queued once all of the account changes have been saved.
+                    email_change_notifications = [
+                        (subject, message, from_address, existing_user.email),
+                        (subject, message, from_address, new_email),
+                    ]
+                else:
+                    # Send it to the old email...
+                    try:
+                        existing_user.email_user(
+                            subject,
+                            message,
+                            from_address
+                        )
+                    except Exception as err:  # pylint: disable=broad-except
+                        transaction.set_rollback(True)
+                        raise AccountUpdateError(
+                            u"Error thrown from emailing old email address for user: '{}'".format(err.message),
+                            user_message=err.message
+                        )
 
                 existing_user.email = new_email
                 # Explicitly activate any non-active user, validated through migration already
                 existing_user.is_active = True
                 existing_user.save()
 
-                # And send it to the new email...
-                try:
-                    existing_user.email_user(
-                        subject,
-                        message,
-                        configuration_helpers.get_value('email_from_address', settings.DEFAULT_FROM_EMAIL)
-                    )
-                except Exception:  # pylint: disable=broad-except
-                    transaction.set_rollback(True)
-                    raise AccountUpdateError(
-                        u"Error thrown from emailing new email address for user: '{}'".format(err.message),
-                        user_message=err.message
-                    )
+                if not send_notifications_async:
+                    # And send it to the new email...
+                    try:
+                        existing_user.email_user(
+                            subject,
+                            message,
+                            from_address
+                        )
+                    except Exception as err:  # pylint: disable=broad-except
+                        transaction.set_rollback(True)
+                        raise AccountUpdateError(
+                            u"Error thrown from emailing new email address for user: '{}'".format(err.message),
+                            user_message=err.message
+                        )
         else:
             try:
                 student_views.do_email_change_request(existing_user, new_email)
@@ -305,6 +358,7 @@ def update_account_settings(requesting_user, update, username=None, force_email_
     if force_email_update and msa_migration_enabled:
         try:
             # Flag to show user has completed and confirmed Microsoft Account Migration
+            meta = existing_user_profile.get_meta()
             meta[settings.MSA_ACCOUNT_MIGRATION_STATUS_KEY] = settings.MSA_MIGRATION_STATUS_COMPLETED
             existing_user_profile.set_meta(meta)
             existing_user_profile.save()
@@ -315,15 +369,21 @@ def update_account_settings(requesting_user, update, username=None, force_email_
                 user_message=err.message
             )
 
+    # Django 1.8 has no transaction.on_commit, so when this is called inside an atomic block
+    # (including ATOMIC_REQUESTS) the notifications are queued before the change is committed,
+    # and will still be sent if the caller's transaction is rolled back.
+    for subject, message, from_address, dest_addr in email_change_notifications:
+        send_email_change_notification.delay(subject, message, from_address, dest_addr)
+
 
 def _get_user_and_profile(username):
     """
     Helper method to return the legacy user and profile objects based on username.
     """
     try:
-        existing_user = User.objects.get(username=username)
-        existing_user_profile = UserProfile.objects.get(user=existing_user)
-    except ObjectDoesNotExist:
+        existing_user = User.objects.select_related('profile').get(username=username)
+        existing_user_profile = existing_user.profile
+    except (User.DoesNotExist, UserProfile.DoesNotExist):
         raise UserNotFound()
 
     return existing_user, existing_user_profile
@@ -389,8 +449,10 @@ def create_account(username, password, email):
     registration = Registration()
     registration.register(user)
 
-    # Create an empty user profile with default values
-    UserProfile(user=user).save()
+    # Create an empty user profile with default values.
+    # bulk_create skips the UserProfile save signals, which only track changes to
+    # existing profiles and so would just issue a wasted lookup for this new one.
+    UserProfile.objects.bulk_create([UserProfile(user=user)])
 
     # Return the activation key, which the caller should send to the user
     return registration.activation_key
@@ -413,15 +475,20 @@ def check_account_exists(username=None, email=None):
         ["email", "username"]
 
     """
-    conflicts = []
+    # Count matches for each supplied field in a single query, letting the
+    # database apply its own comparison rules (e.g. case-insensitive collations).
+    lookup = Q()
+    conflict_counts = {}
+    for field_name, value in (("email", email), ("username", username)):
+        if value is not None:
+            lookup |= Q(**{field_name: value})
+            conflict_counts[field_name + "_conflicts"] = Count(Case(When(then=Value(1), **{field_name: value})))
 
-    if email is not None and User.objects.filter(email=email).exists():
-        conflicts.append("email")
+    if not conflict_counts:
+        return []
 
-    if username is not None and User.objects.filter(username=username).exists():
-        conflicts.append("username")
-
-    return conflicts
+    matches = User.objects.filter(lookup).aggregate(**conflict_counts)
+    return [field_name for field_name in ("email", "username") if matches.get(field_name + "_conflicts")]
 
 
 @intercept_errors(UserAPIInternalError, ignore_errors=[UserAPIRequestError])
@@ -499,23 +566,22 @@ def _validate_username(username):
     if not isinstance(username, basestring):
         raise AccountUsernameInvalid(u"Username must be a string")
 
-    if len(username) < USERNAME_MIN_LENGTH:
+    username_length = len(username)
+    if username_length < USERNAME_MIN_LENGTH:
         raise AccountUsernameInvalid(
             u"Username '{username}' must be at least {min} characters long".format(
                 username=username,
                 min=USERNAME_MIN_LENGTH
             )
         )
-    if len(username) > USERNAME_MAX_LENGTH:
+    if username_length > USERNAME_MAX_LENGTH:
         raise AccountUsernameInvalid(
             u"Username '{username}' must be at most {max} characters long".format(
                 username=username,
                 max=USERNAME_MAX_LENGTH
             )
         )
-    try:
-        validate_slug(username)
-    except ValidationError:
+    if not _USERNAME_SLUG_RE.match(username):
         raise AccountUsernameInvalid(
             u"Username '{username}' must contain only A-Z, a-z, 0-9, -, or _ characters"
         )
@@ -541,14 +607,15 @@ def _validate_password(password, username):
     if not isinstance(password, basestring):
         raise AccountPasswordInvalid(u"Password must be a string")
 
-    if len(password) < PASSWORD_MIN_LENGTH:
+    password_length = len(password)
+    if password_length < PASSWORD_MIN_LENGTH:
         raise AccountPasswordInvalid(
             u"Password must be at least {min} characters long".format(
                 min=PASSWORD_MIN_LENGTH
             )
         )
 
-    if len(password) > PASSWORD_MAX_LENGTH:
+    if password_length > PASSWORD_MAX_LENGTH:
         raise AccountPasswordInvalid(
             u"Password must be at most {max} characters long".format(
                 max=PASSWORD_MAX_LENGTH
@@ -575,7 +642,8 @@ def _validate_email(email):
     if not isinstance(email, basestring):
         raise AccountEmailInvalid(u"Email must be a string")
 
-    if len(email) < EMAIL_MIN_LENGTH:
+    email_length = len(email)
+    if email_length < EMAIL_MIN_LENGTH:
         raise AccountEmailInvalid(
             u"Email '{email}' must be at least {min} characters long".format(
                 email=email,
@@ -583,7 +651,7 @@ def _validate_email(email):
             )
         )
 
-    if len(email) > EMAIL_MAX_LENGTH:
+    if email_length > EMAIL_MAX_LENGTH:
         raise AccountEmailInvalid(
             u"Email '{email}' must be at most {max} characters long".format(
                 email=email,
@@ -591,6 +659,9 @@ def _validate_email(email):
             )
         )
 
+    if _COMMON_EMAIL_RE.match(email):
+        return
+
     try:
         validate_email(email)
     except ValidationError:
@@ -622,39 +693,36 @@ def delete_user_account(username):
 
     existing_user, existing_user_profile = _get_user_and_profile(username)
 
-    # If we get here the user must have a profile, delete this record
-    existing_user_profile.delete()
-
-    # Delete user's social auth records if they exist
-    social_auth_records = UserSocialAuth.objects.filter(user=existing_user)
-    for social_auth_record in social_auth_records:
-        social_auth_record.delete()
-
-    # Delete user's Microsoft Live account PUID mapping if it exists
-    try:
-        social_auth_mapping = UserSocialAuthMapping.objects.get(user=existing_user)
-        social_auth_mapping.delete()
-    except Exception:
-        # This error is most likely a *.DoesNotExist,
-        # meaning the user does not have a social auth record
-        # We don't need to do anything special here and
-        # should NOT raise an exception
-        pass
-
-    # Anonymize the user's records
-    username_mask = str(random.randint(1, 9999)) + username
-    existing_user.username = hashlib.md5(username_mask).hexdigest()
-    existing_user.email = existing_user.username + "@deleteduser.com"
-    existing_user.first_name = 'first_deleted'
-    existing_user.last_name = 'last_deleted'
-    existing_user.is_active = False
-    existing_user.is_staff = False
-    existing_user.save()
-    # Anonymize forum discussions
+    # Commit all local database changes together. The forums are updated
+    # afterwards so that no remote calls are made inside the transaction.
+    with transaction.atomic():
+        # If we get here the user must have a profile, delete this record
+        existing_user_profile.delete()
+
+        # Delete user's social auth records if they exist
+        UserSocialAuth.objects.filter(user=existing_user).delete()
+
+        # Delete user's Microsoft Live account PUID mapping if it exists
+        UserSocialAuthMapping.objects.filter(user=existing_user).delete()
+
+        # Anonymize the user's records
+        existing_user.username = uuid.uuid4().hex
+        existing_user.email = existing_user.username + "@deleteduser.com"
+        existing_user.first_name = 'first_deleted'
+        existing_user.last_name = 'last_deleted'
+        existing_user.is_active = False
+        existing_user.is_staff = False
+        existing_user.save()
+
+    # Anonymize forum discussions. The account has already been anonymized at this
+    # point, so a failure to reach the comments service must not fail the deletion.
     try:
         anonymize_user_discussions(existing_user, username)
-    except Exception:
-        pass
+    except cc.CommentClientMaintenanceError as error:
+        # Raised whenever the forums are disabled or down for maintenance, so this is not unexpected.
+        log.warning(u"Unable to anonymize the discussions of deleted user %s: %s", existing_user.id, error)
+    except (cc.CommentClientError, RequestException):
+        log.exception(u"Unable to anonymize the discussions of deleted user %s", existing_user.id)
 
     # Successful user soft delete
     return True
@@ -674,8 +742,14 @@ def anonymize_user_discussions(user, old_username):
         >>> anonymize_user_discussions(122, 'staff', '570810a83dee178ca19a05f2838839')
     """
 
-    # Getting all courses for the user
-    courses = get_courses(user)
+    # Users can only post in courses they are (or were) enrolled in, or in which they
+    # were given a forum role (forum admins, moderators and community TAs need not be
+    # enrolled), so there is no need to search every course in the catalog.
+    course_ids = set(CourseEnrollment.objects.filter(user=user).values_list('course_id', flat=True))
+    course_ids.update(
+        course_id for course_id in Role.objects.filter(users=user).values_list('course_id', flat=True)
+        if course_id
+    )
     # Updating discussion user instance
     updated_user = ThreadUser.from_django_user(user)
     updated_user.save()
@@ -685,20 +759,56 @@ def anonymize_user_discussions(user, old_username):
         'author_username': old_username,
         'retired_username': user.username
     }
-    for course in courses:
-        query_params['course_id'] = str(course.id)
-        discussion_entities = Thread.search(query_params)
-        for entity in discussion_entities.collection:
-            # 'pinned' key needs to be removed
-            # before update as its read-only
-            del entity['pinned']
-            # Initializing thread for update
-            th = Thread()
-            th.id = entity['id']
-            entity['anonymous'] = True
-            entity['anonymous_to_peers'] = True
-            entity['author_username'] = user.username
-            th.save(entity)
+    # The thread updates are independent requests to the comments service, so they
+    # are sent concurrently, up to the configured number of workers. The pool is only
+    # started once a course has more than one thread to update.
+    max_workers = getattr(settings, 'ACCOUNT_DELETION_FORUM_UPDATE_WORKERS', 1)
+    pool = None
+    language = translation.get_language()
+
+    def anonymize_thread_in_worker(entity):
+        """
+        Anonymize a thread from a pool worker, which does not share the request
+        thread's active language or database connection.
+        """
+        try:
+            with translation.override(language):
+                _anonymize_thread(entity, user.username)
+        finally:
+            connection.close()
+
+    try:
+        for course_id in sorted(course_ids, key=unicode):
+            query_params['course_id'] = str(course_id)
+            discussion_entities = Thread.search(query_params)
+            if max_workers > 1 and len(discussion_entities.collection) > 1:
+                if pool is None:
+                    pool = ThreadPool(max_workers)
+                pool.map(anonymize_thread_in_worker, discussion_entities.collection)
+            else:
+                for entity in discussion_entities.collection:
+                    _anonymize_thread(entity, user.username)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
     # Anonymize all the replys to threads by user
     profiled_user = cc.User(id=user.id)
     profiled_user.retire_threads(query_params)
+
+
+def _anonymize_thread(entity, username):
+    """
+    Update a single discussion thread, as returned by Thread.search, to be anonymous
+    and authored by the given (masked) username.
+    """
+    # 'pinned' key needs to be removed
+    # before update as its read-only
+    entity.pop('pinned', None)
+    # Initializing thread for update
+    th = Thread()
+    th.id = entity['id']
+    entity['anonymous'] = True
+    entity['anonymous_to_peers'] = True
+    entity['author_username'] = username
+    th.save(entity)
@@ -55,6 +55,9 @@ class UserReadOnlySerializer(serializers.Serializer):
         # Don't pass the 'custom_fields' arg up to the superclass
         self.custom_fields = kwargs.pop('custom_fields', [])
 
+        # Don't pass the 'account_privacy_preferences' arg up to the superclass
+        self.account_privacy_preferences = kwargs.pop('account_privacy_preferences', None)
+
         super(UserReadOnlySerializer, self).__init__(*args, **kwargs)
 
     def to_representation(self, user):
@@ -64,11 +67,21 @@ class UserReadOnlySerializer(serializers.Serializer):
         :return: Dict serialized account
         """
         profile = user.profile
-        accomplishments_shared = badges_enabled()
+        request = self.context.get('request')
+
+        # The visibility preference decides which fields are returned, so look it up once
+        # and only build the more expensive values when they will actually be returned.
+        account_privacy = get_profile_visibility(
+            profile, user, self.configuration, self.account_privacy_preferences
+        )
+        if self.custom_fields:
+            fields = self.custom_fields
+        else:
+            fields = _visible_fields_for_profile_visibility(account_privacy, self.configuration)
 
         data = {
             "username": user.username,
-            "url": self.context.get('request').build_absolute_uri(
+            "url": request.build_absolute_uri(
                 reverse('accounts_api', kwargs={'username': user.username})
             ),
             "email": user.email,
@@ -80,15 +93,6 @@ class UserReadOnlySerializer(serializers.Serializer):
             "is_active": user.is_active,
             "bio": AccountLegacyProfileSerializer.convert_empty_to_None(profile.bio),
             "country": AccountLegacyProfileSerializer.convert_empty_to_None(profile.country.code),
-            "profile_image": AccountLegacyProfileSerializer.get_profile_image(
-                profile,
-                user,
-                self.context.get('request')
-            ),
-            "language_proficiencies": LanguageProficiencySerializer(
-                profile.language_proficiencies.all(),
-                many=True
-            ).data,
             "name": profile.name,
             "gender": AccountLegacyProfileSerializer.convert_empty_to_None(profile.gender),
             "goals": profile.goals,
@@ -96,14 +100,19 @@ class UserReadOnlySerializer(serializers.Serializer):
             "level_of_education": AccountLegacyProfileSerializer.convert_empty_to_None(profile.level_of_education),
             "mailing_address": profile.mailing_address,
             "requires_parental_consent": profile.requires_parental_consent(),
-            "accomplishments_shared": accomplishments_shared,
-            "account_privacy": get_profile_visibility(profile, user, self.configuration),
+            "accomplishments_shared": badges_enabled(),
+            "account_privacy": account_privacy,
         }
 
-        if self.custom_fields:
-            fields = self.custom_fields
-        else:
-            fields = _visible_fields(profile, user, self.configuration)
+        if "profile_image" in fields:
+            data["profile_image"] = AccountLegacyProfileSerializer.get_profile_image(profile, user, request)
+
+        if "language_proficiencies" in fields:
+            # Built directly rather than through LanguageProficiencySerializer, which
+            # produces the same {"code": ...} dicts at a much higher cost per user.
+            data["language_proficiencies"] = [
+                {"code": language.code} for language in profile.language_proficiencies.all()
+            ]
 
         return self._filter_fields(
             fields,
@@ -240,17 +249,25 @@ class AccountLegacyProfileSerializer(serializers.HyperlinkedModelSerializer, Rea
         return instance
 
 
-def get_profile_visibility(user_profile, user, configuration=None):
-    """Returns the visibility level for the specified user profile."""
+def get_profile_visibility(user_profile, user, configuration=None, account_privacy_preferences=None):
+    """
+    Returns the visibility level for the specified user profile.
+
+    `account_privacy_preferences` optionally maps user ids to their already looked up
+    visibility preference, in which case no query is made for the preference.
+    """
     if user_profile.requires_parental_consent():
         return PRIVATE_VISIBILITY
 
     if not configuration:
         configuration = settings.ACCOUNT_VISIBILITY_CONFIGURATION
 
-    # Calling UserPreference directly because the requesting user may be different from existing_user
-    # (and does not have to be is_staff).
-    profile_privacy = UserPreference.get_value(user, ACCOUNT_VISIBILITY_PREF_KEY)
+    if account_privacy_preferences is not None:
+        profile_privacy = account_privacy_preferences.get(user.id)
+    else:
+        # Calling UserPreference directly because the requesting user may be different from existing_user
+        # (and does not have to be is_staff).
+        profile_privacy = UserPreference.get_value(user, ACCOUNT_VISIBILITY_PREF_KEY)
     return profile_privacy if profile_privacy else configuration.get('default_visibility')
 
 
@@ -268,6 +285,17 @@ def _visible_fields(user_profile, user, configuration=None):
         configuration = settings.ACCOUNT_VISIBILITY_CONFIGURATION
 
     profile_visibility = get_profile_visibility(user_profile, user, configuration)
+    return _visible_fields_for_profile_visibility(profile_visibility, configuration)
+
+
+def _visible_fields_for_profile_visibility(profile_visibility, configuration):
+    """
+    Return what fields should be visible for an already known profile visibility
+
+    :param profile_visibility: The profile visibility, as returned by get_profile_visibility
+    :param configuration: A visibility configuration dictionary.
+    :return: whitelist List of fields to be shown
+    """
     if profile_visibility == ALL_USERS_VISIBILITY:
         return configuration.get('shareable_fields')
     else:
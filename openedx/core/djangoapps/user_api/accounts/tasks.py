@@ -0,0 +1,46 @@
+"""
+Celery tasks for the User API Accounts sub-application
+"""
+import logging
+
+from boto.exception import NoAuthHandlerFound
+from celery.exceptions import MaxRetriesExceededError
+from celery.task import task  # pylint: disable=no-name-in-module, import-error
+from django.conf import settings
+from django.core import mail
+
+log = logging.getLogger('edx.celery.task')
+
+
+@task(bind=True)
+def send_email_change_notification(self, subject, message, from_address, dest_addr):
+    """
+    Send the notification of a completed email address change to one of the
+    user's (old or new) email addresses.
+    """
+    max_retries = settings.RETRY_EMAIL_CHANGE_NOTIFICATION_MAX_ATTEMPTS
+    retries = self.request.retries
+    try:
+        mail.send_mail(subject, message, from_address, [dest_addr], fail_silently=False)
+        log.info("Email change notification has been sent to User {user_email}".format(
+            user_email=dest_addr
+        ))
+    except NoAuthHandlerFound:
+        log.info('Retrying sending email change notification to user {dest_addr}, attempt # {attempt} of '
+                 '{max_attempts}'.format(dest_addr=dest_addr, attempt=retries, max_attempts=max_retries))
+        try:
+            self.retry(countdown=settings.RETRY_EMAIL_CHANGE_NOTIFICATION_TIMEOUT, max_retries=max_retries)
+        except MaxRetriesExceededError:
+            log.error(
+                'Unable to send email change notification to user from "%s" to "%s"',
+                from_address,
+                dest_addr,
+                exc_info=True
+            )
+    except Exception:  # pylint: disable=broad-except
+        log.exception(
+            'Unable to send email change notification to user from "%s" to "%s"',
+            from_address,
+            dest_addr,
+        )
+        raise
@@ -4,30 +4,44 @@ Unit tests for behavior that is specific to the api methods (vs. the view method
 Most of the functionality is covered in test_views.py.
 """
 import re
+from multiprocessing.pool import ThreadPool
+
 import ddt
 from dateutil.parser import parse as parse_datetime
 
 from mock import Mock, patch
 from django.test import TestCase
+from django.test.utils import override_settings
 from nose.plugins.attrib import attr
 from nose.tools import raises
 import unittest
-from student.tests.factories import UserFactory
+from django_comment_common.models import FORUM_ROLE_MODERATOR, assign_role
+from lms.lib.comment_client import CommentClientMaintenanceError, CommentClientRequestError
+from opaque_keys.edx.locator import CourseLocator
+from student.tests.factories import CourseEnrollmentFactory, UserFactory
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core import exceptions, mail
 from django.test.client import RequestFactory
-from student.models import PendingEmailChange
+from social.apps.django_app.default.models import UserSocialAuth
+from openedx.core.djangoapps.user_api.models import UserPreference
+from student.models import LanguageProficiency, PendingEmailChange, UserProfile
+from third_party_auth.models import UserSocialAuthMapping
 from student.tests.tests import UserSettingsEventTestMixin
 from ...errors import (
     UserNotFound, UserNotAuthorized, AccountUpdateError, AccountValidationError,
-    AccountUserAlreadyExists, AccountUsernameInvalid, AccountEmailInvalid, AccountPasswordInvalid, AccountRequestError
+    AccountUserAlreadyExists, AccountUsernameInvalid, AccountEmailInvalid, AccountPasswordInvalid, AccountRequestError,
+    UserAPIInternalError
 )
 from ..api import (
     get_account_settings, update_account_settings, create_account,
-    activate_account, request_password_change, delete_user_account
+    activate_account, request_password_change, delete_user_account, check_account_exists,
+    anonymize_user_discussions
+)
+from .. import (
+    ACCOUNT_VISIBILITY_PREF_KEY, ALL_USERS_VISIBILITY, USERNAME_MAX_LENGTH, EMAIL_MAX_LENGTH, PASSWORD_MAX_LENGTH,
+    PRIVATE_VISIBILITY
 )
-from .. import USERNAME_MAX_LENGTH, EMAIL_MAX_LENGTH, PASSWORD_MAX_LENGTH, PRIVATE_VISIBILITY
 
 
 def mock_render_to_string(template_name, context):
@@ -36,6 +50,7 @@ def mock_render_to_string(template_name, context):
 
 
 @attr(shard=2)
+@ddt.ddt
 @unittest.skipUnless(settings.ROOT_URLCONF == 'lms.urls', 'Account APIs are only supported in LMS')
 class TestAccountApi(UserSettingsEventTestMixin, TestCase):
     """
@@ -92,6 +107,40 @@ class TestAccountApi(UserSettingsEventTestMixin, TestCase):
         )[0]
         self.assertEqual(self.different_user.email, account_settings["email"])
 
+    @ddt.data(
+        ("user", ALL_USERS_VISIBILITY, "shareable_fields"),
+        ("user", PRIVATE_VISIBILITY, "public_fields"),
+        ("staff_user", PRIVATE_VISIBILITY, "admin_fields"),
+    )
+    @ddt.unpack
+    def test_get_multiple_accounts_queries(self, requesting_user, visibility, expected_fields):
+        """
+        Test that getting the settings of several accounts takes as many queries as getting one, whichever
+        fields are returned. Any field not loaded by get_account_settings would take an extra query per account.
+        """
+        request = self.request_factory.get("/api/user/v1/accounts/")
+        request.user = getattr(self, requesting_user)
+        users = [
+            UserFactory.create(
+                profile__year_of_birth=1980,
+                profile__profile_image_uploaded_at=parse_datetime("2017-01-01T00:00:00Z"),
+            )
+            for __ in range(3)
+        ]
+        for user in users:
+            LanguageProficiency.objects.create(user_profile=user.profile, code="en")
+            UserPreference.objects.create(user=user, key=ACCOUNT_VISIBILITY_PREF_KEY, value=visibility)
+
+        # Users with their profiles, their language proficiencies, and their visibility preferences.
+        with self.assertNumQueries(3):
+            get_account_settings(request, [users[0].username])
+        with self.assertNumQueries(3):
+            account_settings = get_account_settings(request, [user.username for user in users])
+
+        self.assertEqual(len(users), len(account_settings))
+        for account in account_settings:
+            self.assertItemsEqual(settings.ACCOUNT_VISIBILITY_CONFIGURATION[expected_fields], account.keys())
+
     def test_get_user_not_found(self):
         """Test that UserNotFound is thrown if there is no user with username."""
         with self.assertRaises(UserNotFound):
@@ -193,6 +242,58 @@ class TestAccountApi(UserSettingsEventTestMixin, TestCase):
         account_settings = get_account_settings(self.default_request)[0]
         self.assertEqual("Mickey Mouse", account_settings["name"])
 
+    def _force_email_update(self, new_email):
+        """
+        Force update the user's email address with MSA migration enabled.
+        """
+        def get_value(name, default=None):
+            """ Site configuration with MSA migration enabled. """
+            return True if name == 'ENABLE_MSA_MIGRATION' else default
+
+        with patch(
+            'openedx.core.djangoapps.user_api.accounts.api.configuration_helpers.get_value',
+            Mock(side_effect=get_value)
+        ):
+            with patch(
+                'openedx.core.djangoapps.user_api.accounts.api.render_to_string',
+                Mock(side_effect=mock_render_to_string, autospec=True)
+            ):
+                update_account_settings(self.user, {"email": new_email}, force_email_update=True)
+
+    @patch.dict(settings.FEATURES, {'ENABLE_ASYNC_EMAIL_CHANGE_NOTIFICATIONS': True})
+    @patch('openedx.core.djangoapps.user_api.accounts.api.send_email_change_notification')
+    def test_force_email_update_queues_notifications(self, send_notification):
+        """Test that a forced email update queues a notification to both the old and new addresses."""
+        old_email = self.user.email
+        self._force_email_update("forced@example.com")
+
+        self.assertEqual("forced@example.com", User.objects.get(id=self.user.id).email)
+        self.assertEqual(
+            [old_email, "forced@example.com"],
+            [args[3] for args, __ in send_notification.delay.call_args_list]
+        )
+        self.assertEqual(0, len(mail.outbox))
+
+    @patch.dict(settings.FEATURES, {'ENABLE_ASYNC_EMAIL_CHANGE_NOTIFICATIONS': False})
+    def test_force_email_update_sync_notifications(self):
+        """Test that notifications are sent during the request when they are not sent asynchronously."""
+        old_email = self.user.email
+        self._force_email_update("forced@example.com")
+
+        self.assertEqual("forced@example.com", User.objects.get(id=self.user.id).email)
+        self.assertEqual([[old_email], ["forced@example.com"]], [message.to for message in mail.outbox])
+
+    @patch.dict(settings.FEATURES, {'ENABLE_ASYNC_EMAIL_CHANGE_NOTIFICATIONS': False})
+    @patch('django.contrib.auth.models.User.email_user', Mock(side_effect=[None, Exception("Send failed")]))
+    def test_force_email_update_sync_notification_fails(self):
+        """Test that the email change is rolled back if a notification cannot be sent."""
+        old_email = self.user.email
+        with self.assertRaises(AccountUpdateError) as context_manager:
+            self._force_email_update("forced@example.com")
+        self.assertIn("Error thrown from emailing new email address", context_manager.exception.developer_message)
+
+        self.assertEqual(old_email, User.objects.get(id=self.user.id).email)
+
     @patch('openedx.core.djangoapps.user_api.accounts.serializers.AccountUserSerializer.save')
     def test_serializer_save_fails(self, serializer_save):
         """
@@ -364,6 +465,20 @@ class AccountCreationActivationAndPasswordChangeTest(TestCase):
         with self.assertRaises(AccountUserAlreadyExists):
             create_account('different_user', self.PASSWORD, self.EMAIL)
 
+    def test_check_account_exists(self):
+        self.assertEqual(check_account_exists(), [])
+        self.assertEqual(check_account_exists(username=self.USERNAME, email=self.EMAIL), [])
+
+        create_account(self.USERNAME, self.PASSWORD, self.EMAIL)
+        UserFactory.create(username='other_user', email='other@example.com')
+
+        self.assertEqual(check_account_exists(username=self.USERNAME), ["username"])
+        self.assertEqual(check_account_exists(email=self.EMAIL), ["email"])
+        self.assertEqual(check_account_exists(username=self.USERNAME, email=self.EMAIL), ["email", "username"])
+        # Conflicts may come from two different accounts.
+        self.assertEqual(check_account_exists(username='other_user', email=self.EMAIL), ["email", "username"])
+        self.assertEqual(check_account_exists(username='unused_username', email='unused@example.com'), [])
+
     def test_username_too_long(self):
         long_username = 'e' * (USERNAME_MAX_LENGTH + 1)
         with self.assertRaises(AccountUsernameInvalid):
@@ -476,3 +591,145 @@ class UserDeleteTest(TestCase):
         self.assertEqual(deleted_user.last_name, 'last_deleted')
         self.assertFalse(deleted_user.is_active)
         self.assertFalse(deleted_user.is_staff)
+
+    def test_delete_user_account_save_error(self):
+        """
+        Test that the profile and social auth records are kept if the user cannot be anonymized
+        """
+        user = UserFactory.create()
+        UserSocialAuth.objects.create(user=user, provider='live', uid='test-uid')
+        UserSocialAuthMapping.objects.create(user=user, uid='test-uid', puid='test-puid')
+
+        with patch('django.contrib.auth.models.User.save', Mock(side_effect=Exception("Save failed"))):
+            with self.assertRaises(UserAPIInternalError):
+                delete_user_account(user.username)
+
+        self.assertTrue(UserProfile.objects.filter(user=user).exists())
+        self.assertTrue(UserSocialAuth.objects.filter(user=user).exists())
+        self.assertTrue(UserSocialAuthMapping.objects.filter(user=user).exists())
+        self.assertEqual(user.username, User.objects.get(id=user.id).username)
+
+    @patch('openedx.core.djangoapps.user_api.accounts.api.log')
+    @patch(
+        'openedx.core.djangoapps.user_api.accounts.api.anonymize_user_discussions',
+        Mock(side_effect=CommentClientRequestError("Forum update failed"))
+    )
+    def test_delete_user_account_forum_error(self, mock_log):
+        """
+        Test that a comments service error does not fail the deletion, but is logged
+        """
+        user = UserFactory.create()
+
+        self.assertTrue(delete_user_account(user.username))
+        self.assertFalse(User.objects.get(id=user.id).is_active)
+        mock_log.exception.assert_called_once_with(
+            u"Unable to anonymize the discussions of deleted user %s", user.id
+        )
+
+    @patch('openedx.core.djangoapps.user_api.accounts.api.log')
+    def test_delete_user_account_forums_disabled(self, mock_log):
+        """
+        Test that the comments service being disabled is logged as a warning, without a traceback
+        """
+        user = UserFactory.create()
+        error = CommentClientMaintenanceError('service disabled')
+
+        with patch('openedx.core.djangoapps.user_api.accounts.api.anonymize_user_discussions', Mock(side_effect=error)):
+            self.assertTrue(delete_user_account(user.username))
+
+        self.assertFalse(User.objects.get(id=user.id).is_active)
+        mock_log.warning.assert_called_once_with(
+            u"Unable to anonymize the discussions of deleted user %s: %s", user.id, error
+        )
+        self.assertFalse(mock_log.exception.called)
+
+    @patch(
+        'openedx.core.djangoapps.user_api.accounts.api.anonymize_user_discussions',
+        Mock(side_effect=ValueError("Unexpected error"))
+    )
+    def test_delete_user_account_unexpected_error(self):
+        """
+        Test that errors other than comments service errors are not swallowed
+        """
+        user = UserFactory.create()
+
+        with self.assertRaises(UserAPIInternalError):
+            delete_user_account(user.username)
+
+
+@attr(shard=2)
+class AnonymizeUserDiscussionsTest(TestCase):
+    """
+    Test anonymization of a deleted user's discussion threads
+    """
+    def setUp(self):
+        super(AnonymizeUserDiscussionsTest, self).setUp()
+        for target in ('lms.lib.comment_client.user.User.save', 'lms.lib.comment_client.user.User.retire_threads'):
+            patcher = patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.user = UserFactory.create()
+        self.old_username = self.user.username
+        self.user.username = 'anonymized_username'
+        self.enrolled_course_key = CourseLocator('edX', 'enrolled', 'run')
+        self.moderated_course_key = CourseLocator('edX', 'moderated', 'run')
+
+    def _anonymize_and_get_searched_course_ids(self):
+        """
+        Anonymize the user's discussions, with no threads found, and return the ids
+        of the courses which were searched.
+        """
+        searched_course_ids = []
+
+        def search(query_params):
+            """ Record the searched course, which is updated in place between searches. """
+            searched_course_ids.append(query_params['course_id'])
+            return Mock(collection=[])
+
+        with patch('lms.lib.comment_client.thread.Thread.search', side_effect=search):
+            anonymize_user_discussions(self.user, self.old_username)
+        return searched_course_ids
+
+    def test_searches_enrolled_courses(self):
+        CourseEnrollmentFactory.create(user=self.user, course_id=self.enrolled_course_key)
+        self.assertEqual(self._anonymize_and_get_searched_course_ids(), [unicode(self.enrolled_course_key)])
+
+    def test_searches_forum_role_courses_without_enrollment(self):
+        CourseEnrollmentFactory.create(user=self.user, course_id=self.enrolled_course_key)
+        assign_role(self.moderated_course_key, self.user, FORUM_ROLE_MODERATOR)
+        self.assertEqual(
+            self._anonymize_and_get_searched_course_ids(),
+            sorted([unicode(self.enrolled_course_key), unicode(self.moderated_course_key)])
+        )
+
+    @override_settings(ACCOUNT_DELETION_FORUM_UPDATE_WORKERS=2)
+    def test_concurrent_thread_anonymization(self):
+        CourseEnrollmentFactory.create(user=self.user, course_id=self.enrolled_course_key)
+        entities = [
+            {'id': 'thread_{}'.format(index), 'pinned': False, 'author_username': self.old_username}
+            for index in range(5)
+        ]
+        with patch('lms.lib.comment_client.thread.Thread.search', return_value=Mock(collection=entities)):
+            with patch('lms.lib.comment_client.thread.Thread.save') as thread_save:
+                with patch('openedx.core.djangoapps.user_api.accounts.api.ThreadPool', wraps=ThreadPool) as pool:
+                    anonymize_user_discussions(self.user, self.old_username)
+
+        pool.assert_called_once_with(2)
+        saved_entities = sorted((call[0][0] for call in thread_save.call_args_list), key=lambda entity: entity['id'])
+        self.assertEqual(saved_entities, [
+            {
+                'id': 'thread_{}'.format(index),
+                'anonymous': True,
+                'anonymous_to_peers': True,
+                'author_username': self.user.username,
+            }
+            for index in range(5)
+        ])
+
+    @override_settings(ACCOUNT_DELETION_FORUM_UPDATE_WORKERS=2)
+    def test_no_pool_without_threads(self):
+        CourseEnrollmentFactory.create(user=self.user, course_id=self.enrolled_course_key)
+        with patch('openedx.core.djangoapps.user_api.accounts.api.ThreadPool') as pool:
+            self._anonymize_and_get_searched_course_ids()
+        self.assertFalse(pool.called)
@@ -0,0 +1,41 @@
+"""
+Tests for the User API Accounts celery tasks
+"""
+
+from boto.exception import NoAuthHandlerFound
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import Mock, patch
+from nose.plugins.attrib import attr
+
+from ..tasks import send_email_change_notification
+
+
+@attr(shard=2)
+class SendEmailChangeNotificationTest(TestCase):
+    """
+    Test the task which sends the email change notifications
+    """
+    @patch('django.core.mail.send_mail')
+    def test_send_email_change_notification(self, send_mail):
+        # pylint: disable=no-member
+        send_email_change_notification.delay('subject', 'message', 'from@example.com', 'to@example.com')
+        send_mail.assert_called_once_with(
+            'subject', 'message', 'from@example.com', ['to@example.com'], fail_silently=False
+        )
+
+    @override_settings(RETRY_EMAIL_CHANGE_NOTIFICATION_MAX_ATTEMPTS=2, RETRY_ACTIVATION_EMAIL_MAX_ATTEMPTS=5)
+    @patch('time.sleep', Mock(return_value=None))
+    @patch('openedx.core.djangoapps.user_api.accounts.tasks.log')
+    @patch('django.core.mail.send_mail', Mock(side_effect=NoAuthHandlerFound))
+    def test_send_email_change_notification_retries(self, mock_log):
+        # pylint: disable=no-member
+        send_email_change_notification.delay('subject', 'message', 'from@example.com', 'to@example.com')
+
+        self.assertEqual(3, mock_log.info.call_count)
+        mock_log.error.assert_called_once_with(
+            'Unable to send email change notification to user from "%s" to "%s"',
+            'from@example.com',
+            'to@example.com',
+            exc_info=True
+        )